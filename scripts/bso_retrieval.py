@@ -1,80 +1,139 @@
 import os
-import requests
+import aiofiles
 import pandas as pd
-import json
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from scripts.http_utils import check_retryable, http_retry
+from scripts.io_utils import ensure_dir, write_csv, write_json, write_metadata_index
 
 BSO_URL = "https://energy.ec.europa.eu/document/download/f09b2e17-00e4-46e0-88ae-970fc15a716f_en?filename=data0.xlsx"
 BSO_FILENAME = "bso.xlsx"
 
-def download_bso_excel(output_dir: str) -> str:
+# Characters replaced by '_' in domain-derived filenames, applied in a single translate pass
+_DOMAIN_TRANS = str.maketrans({' ': '_', '/': '_', '\\': '_'})
+
+BSO_CHUNK_SIZE = 1 << 20  # stream the workbook to disk in 1 MiB chunks
+
+# Sidecar suffix -> (response validator header, conditional request header)
+CACHE_VALIDATORS = {
+    ".etag": ("ETag", "If-None-Match"),
+    ".lastmod": ("Last-Modified", "If-Modified-Since")
+}
+
+@http_retry
+async def _fetch(session, url: str, path: str, semaphore, limiter=None, headers: dict = None):
+    """Stream url into path while holding the shared semaphore. Returns (status, response headers)."""
+    async with semaphore:
+        if limiter:
+            await limiter.acquire()
+        async with session.get(url, headers=headers) as response:
+            check_retryable(response, limiter)
+            if response.status != 200:
+                return response.status, response.headers
+            # Write to a temporary file so an interrupted download never replaces a good cached copy
+            partial_path = f"{path}.part"
+            async with aiofiles.open(partial_path, "wb") as f:
+                async for chunk in response.content.iter_chunked(BSO_CHUNK_SIZE):
+                    await f.write(chunk)
+            os.replace(partial_path, path)
+            return response.status, response.headers
+
+async def download_bso_excel_async(session, semaphore, output_dir: str, limiter=None) -> str:
     file_path = os.path.join(output_dir, BSO_FILENAME)
-    if not os.path.exists(file_path):
-        logging.info("Downloading BSO Excel file...")
-        response = requests.get(BSO_URL)
-        if response.status_code == 200:
-            with open(file_path, "wb") as f:
-                f.write(response.content)
-            logging.info(f"File downloaded and saved as {file_path}")
-        else:
-            logging.error(f"Failed to download file: HTTP {response.status_code}")
-            raise Exception(f"Failed to download file: HTTP {response.status_code}")
+
+    # Revalidate the cached copy with the validators saved alongside it instead of downloading it again
+    headers = {}
+    if os.path.exists(file_path):
+        for suffix, (_, request_header) in CACHE_VALIDATORS.items():
+            if os.path.exists(file_path + suffix):
+                with open(file_path + suffix, "r") as vf:
+                    headers[request_header] = vf.read().strip()
+
+    logging.info("Revalidating cached BSO Excel file..." if headers else "Downloading BSO Excel file...")
+    status, response_headers = await _fetch(session, BSO_URL, file_path, semaphore, limiter, headers)
+    if status == 304:
+        logging.info(f"Using cached file at {file_path} (not modified upstream)")
+    elif status == 200:
+        logging.info(f"File downloaded and saved as {file_path}")
+        for suffix, (response_header, _) in CACHE_VALIDATORS.items():
+            if response_headers.get(response_header):
+                with open(file_path + suffix, "w") as vf:
+                    vf.write(response_headers[response_header])
+            elif os.path.exists(file_path + suffix):
+                os.remove(file_path + suffix)
     else:
-        logging.info(f"Using cached file at {file_path}")
+        logging.error(f"Failed to download file: HTTP {status}")
+        raise Exception(f"Failed to download file: HTTP {status}")
     return file_path
 
-def process_bso_excel(file_path: str, output_dir: str):
+def _write_domain(domain: str, domain_df: pd.DataFrame, output_dir: str, sheet_name: str, legacy_metadata: bool = False) -> dict:
+    domain_clean = domain.lower().translate(_DOMAIN_TRANS)
+
+    csv_filename = f"{domain_clean}.csv"
+    csv_path = os.path.join(output_dir, csv_filename)
+    write_csv(domain_df, csv_path)
+
+    metadata = {
+        "original_excel_file": BSO_FILENAME,
+        "sheet_name": sheet_name,
+        "csv_file": csv_filename,
+        "num_records": len(domain_df),
+        "columns": domain_df.columns.tolist(),
+        "domain": domain,
+        "retrieved_timestamp": datetime.now().isoformat(),
+        "source_url": BSO_URL,
+        "data_source": "EU Building Stock Observatory (BSO)",
+        "description": f"Extracted data for the domain '{domain}' from the EU BSO Excel workbook.",
+        "geographic_coverage": "EU countries",
+        "update_frequency": "Regularly updated by EU DG Energy"
+    }
+
+    if legacy_metadata:
+        metadata_filename = csv_filename.replace('.csv', '_metadata.json')
+        metadata_path = os.path.join(output_dir, metadata_filename)
+
+        write_json(metadata_path, metadata)
+
+    logging.info(f"Saved {csv_filename} and corresponding metadata.")
+    return metadata
+
+def process_bso_excel(file_path: str, output_dir: str, legacy_metadata: bool = False):
     logging.info("Processing BSO Excel file...")
-    xl = pd.ExcelFile(file_path)
 
     sheet_name = 'Export'
     logging.info(f"Processing sheet: {sheet_name}")
-    
-    df = xl.parse(sheet_name)
+
+    # Rust-based calamine reader; no workbook object is kept alive during the CSV writes
+    df = pd.read_excel(file_path, sheet_name=sheet_name, engine='calamine', dtype_backend='pyarrow')
     df.dropna(how='all', inplace=True)
 
     if 'Domain' not in df.columns:
         logging.error("Column 'Domain' not found in sheet. Aborting.")
         raise ValueError("Column 'Domain' not found in Excel sheet.")
 
-    for domain in df['Domain'].dropna().unique():
-        domain_df = df[df['Domain'] == domain]
-        
-        domain_clean = domain.lower().replace(' ', '_').replace('/', '_').replace('\\', '_')
-
-        csv_filename = f"{domain_clean}.csv"
-        csv_path = os.path.join(output_dir, csv_filename)
-        domain_df.to_csv(csv_path, index=False)
-
-        metadata = {
-            "original_excel_file": BSO_FILENAME,
-            "sheet_name": sheet_name,
-            "csv_file": csv_filename,
-            "num_records": len(domain_df),
-            "columns": domain_df.columns.tolist(),
-            "domain": domain,
-            "retrieved_timestamp": datetime.now().isoformat(),
-            "source_url": BSO_URL,
-            "data_source": "EU Building Stock Observatory (BSO)",
-            "description": f"Extracted data for the domain '{domain}' from the EU BSO Excel workbook.",
-            "geographic_coverage": "EU countries",
-            "update_frequency": "Regularly updated by EU DG Energy"
-        }
-
-        metadata_filename = csv_filename.replace('.csv', '_metadata.json')
-        metadata_path = os.path.join(output_dir, metadata_filename)
+    # Single hash-grouping pass over a categorical column instead of one boolean mask per domain
+    df['Domain'] = df['Domain'].astype('category')
+    grouped = df.groupby('Domain', sort=False, observed=True)
 
-        with open(metadata_path, 'w') as mf:
-            json.dump(metadata, mf, indent=4)
+    # Per-domain writes are independent and release the GIL in C-level I/O, so overlap them
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        futures = [
+            executor.submit(_write_domain, domain, domain_df, output_dir, sheet_name, legacy_metadata)
+            for domain, domain_df in grouped
+        ]
+        for future in as_completed(futures):
+            future.result()
 
-        logging.info(f"Saved {csv_filename} and corresponding metadata.")
+    # One metadata index for the folder instead of a JSON file per domain
+    index_path = write_metadata_index(output_dir, [future.result() for future in futures])
+    logging.info(f"Saved metadata index: {index_path}")
 
-def download_and_process_bso_data(output_dir: str):
-    os.makedirs(output_dir, exist_ok=True)
+async def download_and_process_bso_data(session, semaphore, output_dir: str, limiter=None, legacy_metadata: bool = False):
+    ensure_dir(output_dir)
     try:
-        excel_path = download_bso_excel(output_dir)
-        process_bso_excel(excel_path, output_dir)
+        excel_path = await download_bso_excel_async(session, semaphore, output_dir, limiter)
+        process_bso_excel(excel_path, output_dir, legacy_metadata)
         logging.info("All BSO sheets processed successfully.")
     except Exception as e:
         logging.error(f"BSO data retrieval failed: {e}")
@@ -1,67 +1,111 @@
 import os
+import re
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import logging
+from collections import defaultdict
+from itertools import repeat
 from pathlib import Path
-from glob import glob
+from scripts.logging_utils import map_in_processes
+from scripts.io_utils import ensure_dir, first_occurrences, write_json, write_metadata_index
 
-def merge_monthly_to_yearly(input_folder, output_folder):
+# Stream monthly CSVs in 1 MiB blocks; timestamps are parsed in Arrow's C++ reader rather than with pd.to_datetime.
+# Types are pinned because the streaming reader only infers them from the first block.
+CSV_READ_OPTIONS = pacsv.ReadOptions(block_size=1 << 20)
+CSV_CONVERT_OPTIONS = pacsv.ConvertOptions(column_types={
+    'timestamp': pa.timestamp('ns', tz='UTC'),
+    'area_code': pa.string(),
+    'dataset': pa.string(),
+    'production_type': pa.string(),
+    'value': pa.float64(),
+    'unit': pa.string()
+})
+
+# {country}_{bidding_zone}_{dataset}_{YYYYMMDD}_{YYYYMMDD}.csv; dataset may itself contain underscores
+MONTHLY_FILENAME_RE = re.compile(r'^(?P<country>[^_]+)_(?P<bidding_zone>[^_]+)_(?P<dataset>.+)_(?P<start>\d{8})_\d{8}\.csv$')
+
+def merge_monthly_to_yearly(input_folder, output_folder, output_format='parquet', legacy_metadata=False):
     monthly_folder = Path(input_folder)
-    yearly_folder = Path(output_folder)
-    yearly_folder.mkdir(parents=True, exist_ok=True)
+    yearly_folder = ensure_dir(output_folder)
 
     # Clearly find all unique combinations of country, bidding_zone, and dataset
-    monthly_files = glob(str(monthly_folder / '*.csv'))
-    file_groups = {}
-
-    for filepath in monthly_files:
-        filename = os.path.basename(filepath)
-        parts = filename.split('_')
-
-        if len(parts) >= 5:
-            country = parts[0]
-            bidding_zone = parts[1]
-            dataset = '_'.join(parts[2:-2])  # handles datasets with underscores clearly
-            start_date = parts[-2]
-            year = start_date[:4]
-
-            key = (country, bidding_zone, dataset, year)
-            file_groups.setdefault(key, []).append(filepath)
-
-    # Merge explicitly by each key clearly
-    for (country, bidding_zone, dataset, year), files in file_groups.items():
-        try:
-            logging.info(f"Merging files for {country} {bidding_zone} {dataset} {year}")
-            combined_df = pd.concat((pd.read_csv(f) for f in files), ignore_index=True)
-            
-            # Sort explicitly by timestamp to ensure chronological order
-            combined_df['timestamp'] = pd.to_datetime(combined_df['timestamp'])
-            combined_df.sort_values('timestamp', inplace=True)
-
-            # Drop duplicates explicitly
-            combined_df.drop_duplicates(subset=['timestamp', 'production_type'], keep='first', inplace=True)
-
-            # Save explicitly yearly CSV
-            yearly_filename = f"{country}_{bidding_zone}_{dataset}_{year}.csv"
-            combined_df.to_csv(yearly_folder / yearly_filename, index=False)
-
-            # Explicitly merge metadata
-            metadata_files = [f.replace('.csv', '_metadata.json') for f in files if os.path.exists(f.replace('.csv', '_metadata.json'))]
-            metadata = {
-                "country": country,
-                "bidding_zone": bidding_zone,
-                "dataset": dataset,
-                "unit": combined_df['unit'].iloc[0] if 'unit' in combined_df.columns else "",
-                "period_start": combined_df['timestamp'].min().isoformat(),
-                "period_end": combined_df['timestamp'].max().isoformat(),
-                "retrieval_timestamp": pd.Timestamp.now().isoformat(),
-                "source_files": [os.path.basename(f) for f in files]
-            }
-
-            yearly_metadata_filename = yearly_filename.replace('.csv', '_metadata.json')
-            pd.Series(metadata).to_json(yearly_folder / yearly_metadata_filename, indent=4)
-
-            logging.info(f"Saved yearly data: {yearly_filename}")
+    file_groups = defaultdict(list)
+
+    for path in monthly_folder.iterdir():
+        match = MONTHLY_FILENAME_RE.match(path.name)
+        if match:
+            key = (match['country'], match['bidding_zone'], match['dataset'], match['start'][:4])
+            file_groups[key].append(str(path))
+
+    # Groups are independent, so merge them in parallel across processes
+    keys = list(file_groups)
+    files_list = [file_groups[key] for key in keys]
+    results = map_in_processes(
+        _merge_group, keys, files_list, repeat(yearly_folder), repeat(output_format), repeat(legacy_metadata)
+    )
+
+    # Workers hand their metadata back so the folder gets a single index written by one process
+    index_path = write_metadata_index(yearly_folder, [metadata for metadata in results if metadata])
+    logging.info(f"Saved yearly metadata index: {index_path}")
+
+def _first_value(table: pa.Table, column: str, default=""):
+    """First scalar of a column, or default when the column is missing or the table is empty."""
+    if column not in table.column_names or table.num_rows == 0:
+        return default
+    return table[column][0].as_py()
+
+def _merge_group(key, files, yearly_folder, output_format='parquet', legacy_metadata=False):
+    country, bidding_zone, dataset, year = key
+    try:
+        logging.info(f"Merging files for {country} {bidding_zone} {dataset} {year}")
+        # Record batches from each file are referenced as-is (no intermediate DataFrames, no concat copy)
+        monthly_tables = [
+            pa.Table.from_batches(pacsv.open_csv(f, read_options=CSV_READ_OPTIONS, convert_options=CSV_CONVERT_OPTIONS))
+            for f in files
+        ]
+        # The unit is constant per series: take it from the first file rather than the merged table
+        unit = _first_value(monthly_tables[0], 'unit')
+        table = pa.concat_tables(monthly_tables, promote_options='permissive')
+
+        # Sort explicitly by timestamp to ensure chronological order (stable, like the previous pandas sort)
+        table = table.sort_by('timestamp')
+
+        # Drop duplicates explicitly, keeping the first row of each (timestamp, production_type)
+        table = table.take(first_occurrences(table, ['timestamp', 'production_type']))
+
+        # Save yearly data as snappy Parquet, or CSV for consumers that still expect it
+        yearly_stem = f"{country}_{bidding_zone}_{dataset}_{year}"
+        if output_format == 'csv':
+            yearly_filename = f"{yearly_stem}.csv"
+            pacsv.write_csv(table, yearly_folder / yearly_filename)
+        else:
+            yearly_filename = f"{yearly_stem}.parquet"
+            pq.write_table(table, yearly_folder / yearly_filename, compression='snappy', row_group_size=100_000)
+
+        # Explicitly merge metadata
+        period = pc.min_max(table['timestamp'])
+        metadata = {
+            "country": country,
+            "bidding_zone": bidding_zone,
+            "dataset": dataset,
+            "data_file": yearly_filename,
+            "unit": unit,
+            "period_start": period['min'].as_py().isoformat(),
+            "period_end": period['max'].as_py().isoformat(),
+            "retrieval_timestamp": pd.Timestamp.now().isoformat(),
+            "source_files": [os.path.basename(f) for f in files]
+        }
+
+        logging.info(f"Saved yearly data: {yearly_filename}")
+        if legacy_metadata:
+            yearly_metadata_filename = f"{yearly_stem}_metadata.json"
+            write_json(yearly_folder / yearly_metadata_filename, metadata)
             logging.info(f"Saved yearly metadata: {yearly_metadata_filename}")
 
-        except Exception as e:
-            logging.error(f"Error processing {country} {bidding_zone} {dataset} {year}: {e}")
\ No newline at end of file
+        return metadata
+
+    except Exception as e:
+        logging.error(f"Error processing {country} {bidding_zone} {dataset} {year}: {e}")
\ No newline at end of file
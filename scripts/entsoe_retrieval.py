@@ -1,15 +1,30 @@
+import io
 import os
-import requests
-import xmltodict
+import asyncio
+import numpy as np
+from lxml import etree
 import pandas as pd
-import json
 import logging
 from datetime import datetime, timedelta
 import pytz
+from scripts.http_utils import create_session, error_excerpt, fetch, gather_all
+from scripts.io_utils import write_csv, write_json
 
 # ENTSO-E API endpoint and security token from environment variable
 BASE_URL = "https://web-api.tp.entsoe.eu/api"
 API_TOKEN = os.getenv("ENTSOE_API_TOKEN")
+# Minutes per ENTSO-E resolution code; anything else is treated as hourly
+RESOLUTION_MINUTES = {'PT15M': 15, 'PT30M': 30, 'PT60M': 60}
+# Concurrent ENTSO-E requests in flight; the API throttles aggressive clients per token
+ENTSOE_MAX_CONCURRENT_REQUESTS = 8
+# Longest period the API serves in one request (one year for load, generation, prices and capacity)
+ENTSOE_MAX_REQUEST_SPAN = timedelta(days=366)
+# ENTSO-E publishes with a delay and revises recent data, without ETag or Last-Modified to revalidate against.
+# Windows are only treated as settled (cacheable, bulk-fetchable) once they ended at least this long ago.
+ENTSOE_CACHE_SETTLE = timedelta(days=7)
+# Whitespace-only text nodes are dropped at parse time, which keeps the tree small; entities are never expanded.
+# lxml parsers must not be shared between threads, so one is created per response from these options.
+ENTSOE_XML_PARSER_OPTIONS = {'remove_blank_text': True, 'resolve_entities': False}
 
 # Mapping of countries to their bidding zone codes (for day-ahead prices)
 BIDDING_ZONES = {
@@ -80,8 +95,8 @@ def format_date(dt: datetime) -> str:
     # API expects format YYYYMMDDHHMM (UTC)
     return dt.strftime('%Y%m%d%H%M')
 
-def retrieve_entsoe_data(area_code: str, dataset_key: str, start_date: datetime, end_date: datetime) -> pd.DataFrame:
-    """Retrieve data from ENTSO-E API for a given area code and dataset."""
+async def retrieve_entsoe_data(session, semaphore, area_code: str, dataset_key: str, start_date: datetime, end_date: datetime, limiter=None, cache=None) -> pd.DataFrame:
+    """Retrieve data from ENTSO-E API for a given area code and dataset; None when nothing is published, raises on API errors."""
     dataset = DATASETS[dataset_key]
     params = {
         'securityToken': API_TOKEN,
@@ -102,81 +117,114 @@ def retrieve_entsoe_data(area_code: str, dataset_key: str, start_date: datetime,
         params[domain_field] = area_code
 
     logging.info(f"Requesting {dataset_key} for area {area_code} from {start_date} to {end_date}.")
-    response = requests.get(BASE_URL, params=params)
-    if response.status_code != 200:
-        logging.error(f"Request failed for {dataset_key}, area {area_code}: {response.status_code}, {response.text}")
-        return None
+    # Windows that have not settled yet may still be revised upstream, so they always go to the network
+    if end_date > datetime.now(pytz.UTC) - ENTSOE_CACHE_SETTLE:
+        cache = None
+    status, body = await fetch(session, BASE_URL, semaphore, params=params, limiter=limiter, cache=cache)
+    if status != 200:
+        # Callers decide how loud this is: an expected bulk rejection is INFO, a failed window is an ERROR
+        raise Exception(f"API error {status}: {error_excerpt(body)}")
 
-    data_dict = xmltodict.parse(response.text)
-    # The root tag can vary by document type (GL_MarketDocument or Publication_MarketDocument)
-    market_doc = data_dict.get('GL_MarketDocument') or data_dict.get('Publication_MarketDocument')
-    if not market_doc or 'TimeSeries' not in market_doc:
-        # No data available for this query
-        logging.warning(f"No TimeSeries data for {dataset_key}, area {area_code}.")
-        return None
+    # Parsing is CPU-bound; keep it off the event loop so other responses keep streaming in
+    return await asyncio.to_thread(parse_entsoe_response, body, area_code, dataset_key)
+
+def _period_grid(start: str, end: str, resolution: str) -> pd.DatetimeIndex:
+    """Every slot of a Period at its resolution; point positions are 1-based indices into it."""
+    # Determine interval step in minutes from the resolution code (PT15M, PT60M, etc.), hourly if not specified
+    step_minutes = RESOLUTION_MINUTES.get(resolution, 60)
+    return pd.date_range(pd.Timestamp(start), pd.Timestamp(end), freq=pd.Timedelta(minutes=step_minutes), inclusive='left')
 
-    timeseries_list = market_doc['TimeSeries']
-    if not isinstance(timeseries_list, list):
-        timeseries_list = [timeseries_list]
+def _period_frame(positions: np.ndarray, values: np.ndarray, grid: pd.DatetimeIndex, area_code: str, dataset_key: str, prod_type: str, unit: str) -> pd.DataFrame:
+    """Build one Period's rows column-wise, looking timestamps up on the Period's time grid by position-1."""
+    return pd.DataFrame({
+        'timestamp': grid[positions - 1],
+        'area_code': area_code,
+        'dataset': dataset_key,
+        'production_type': prod_type,
+        'value': values,
+        'unit': unit
+    })
 
-    records = []
-    for series in timeseries_list:
-        # Determine production type or price category
-        if dataset_key == "day_ahead_prices":
+def _document_xpaths(namespace) -> dict:
+    """Compiled per-Period XPaths bound to the document's default namespace (GL_ and Publication_ documents differ)."""
+    namespaces = {'d': namespace} if namespace else None
+    d = 'd:' if namespace else ''
+    # Points are kept only with a position and a non-empty value; quantity wins over price.amount, as it always has
+    quantity, price = f"{d}quantity[. != '']", f"{d}price.amount[. != '']"
+    points = f"{d}Point[{d}position != '' and ({quantity} or {price})]"
+    # smart_strings=False returns plain str text nodes without back-references into the tree
+    return {
+        'psr_type': etree.XPath(f'string({d}MktPSRType/{d}psrType)', namespaces=namespaces, smart_strings=False),
+        'start': etree.XPath(f'string({d}timeInterval/{d}start)', namespaces=namespaces, smart_strings=False),
+        'end': etree.XPath(f'string({d}timeInterval/{d}end)', namespaces=namespaces, smart_strings=False),
+        'resolution': etree.XPath(f'string({d}resolution)', namespaces=namespaces, smart_strings=False),
+        # Both select exactly one text node per kept Point, in document order, so the arrays line up
+        'positions': etree.XPath(f'{points}/{d}position[1]/text()', namespaces=namespaces, smart_strings=False),
+        'values': etree.XPath(f'{points}/{quantity}[1]/text() | {points}[not({quantity})]/{price}[1]/text()', namespaces=namespaces, smart_strings=False)
+    }
+
+def parse_entsoe_response(body: bytes, area_code: str, dataset_key: str) -> pd.DataFrame:
+    """Parse an ENTSO-E XML market document into a DataFrame of timestamped values."""
+    # Everything that depends only on the dataset is resolved once per response, not per series or point
+    unit = DATASETS[dataset_key]['unit']
+    is_price = dataset_key == "day_ahead_prices"
+    default_prod_type = dataset_key.title()
+
+    # Periods are streamed: each one is handed over as soon as libxml2 has parsed it, the compiled XPaths pull its
+    # text nodes out in C and NumPy converts them, then it is cleared, so memory stays flat even for a bulk year
+    events = etree.iterparse(io.BytesIO(body), events=('end',), tag=('{*}Period', '{*}TimeSeries'), **ENTSOE_XML_PARSER_OPTIONS)
+    xpaths = None
+    series_count = 0
+    frames = []
+    # Series of one document (e.g. one per PSR type) usually share their Periods, so each time grid is built once
+    grids = {}
+    for _, element in events:
+        if etree.QName(element).localname == 'TimeSeries':
+            # A TimeSeries is complete: all its Periods were consumed and cleared already
+            series_count += 1
+            element.clear(keep_tail=False)
+            element.getparent().remove(element)
+            continue
+        period, series = element, element.getparent()
+        if xpaths is None:
+            xpaths = _document_xpaths(etree.QName(period).namespace)
+
+        # Determine production type or price category (the series header precedes its Periods)
+        if is_price:
             # For prices, we can treat each series as a price curve (no explicit production type)
             prod_type = "Day-ahead Price"
         else:
             # For generation, the MktPSRType field gives the fuel type code
-            psr_code = series.get('MktPSRType', {}).get('psrType')
-            prod_type = PSR_TYPE_MAP.get(psr_code, psr_code or dataset_key.title())
-        
-        # Explicitly handle units to avoid typos/errors
-        if dataset_key == "day_ahead_prices":
-            unit = "EUR/MWh"
-        else:
-            unit = "MW"
-        
-        # Each TimeSeries contains one or more Periods (typically one period per time interval chunk)
-        periods = series['Period'] if isinstance(series['Period'], list) else [series['Period']]
-        for period in periods:
-            interval_start = datetime.fromisoformat(period['timeInterval']['start'].replace('Z', '+00:00'))
-            interval_end = datetime.fromisoformat(period['timeInterval']['end'].replace('Z', '+00:00'))
-            resolution = period.get('resolution', 'PT60M')
-            # Determine interval step in minutes from the resolution code (PT15M, PT60M, etc.)
-            if resolution == 'PT15M':
-                step_minutes = 15
-            elif resolution == 'PT30M':
-                step_minutes = 30
-            else:
-                step_minutes = 60  # default to hourly if not specified or PT60M
-
-            points = period['Point'] if isinstance(period['Point'], list) else [period['Point']]
-            for point in points:
-                position = int(point['position'])
-                # Calculate timestamp for this point: start_time + (position-1)*step_minutes
-                timestamp = interval_start + timedelta(minutes=step_minutes * (position - 1))
-                # Get value (quantity for load/gen, price.amount for prices)
-                value = None
-                if 'quantity' in point:
-                    value = float(point['quantity'])
-                elif 'price.amount' in point:
-                    value = float(point['price.amount'])
-                else:
-                    # If neither field is present, skip
-                    continue
-
-                records.append({
-                    'timestamp': timestamp.isoformat(),
-                    'area_code': area_code,
-                    'dataset': dataset_key,
-                    'production_type': prod_type,
-                    'value': value,
-                    'unit': unit
-                })
-    # Compile into DataFrame
-    df = pd.DataFrame(records)
+            psr_code = xpaths['psr_type'](series) or None
+            prod_type = PSR_TYPE_MAP.get(psr_code, psr_code or default_prod_type)
+
+        positions = np.array(xpaths['positions'](period), dtype=np.intp)
+        if len(positions):
+            values = np.array(xpaths['values'](period), dtype=np.float64)
+            grid_key = (xpaths['start'](period), xpaths['end'](period), xpaths['resolution'](period))
+            if grid_key not in grids:
+                grids[grid_key] = _period_grid(*grid_key)
+            in_period = (positions >= 1) & (positions <= len(grids[grid_key]))
+            if not in_period.all():
+                logging.warning(f"Dropping {np.count_nonzero(~in_period)} points outside their Period for {dataset_key}, area {area_code}.")
+                positions, values = positions[in_period], values[in_period]
+            frames.append(_period_frame(positions, values, grids[grid_key], area_code, dataset_key, prod_type, unit))
+        # Clearing in place frees the Points; detaching the whole subtree would be far slower in lxml
+        period.clear(keep_tail=False)
+
+    if not series_count:
+        # No data available for this query
+        logging.warning(f"No TimeSeries data for {dataset_key}, area {area_code}.")
+        return None
+
+    if not frames:
+        logging.warning(f"No data points for {dataset_key}, area {area_code}.")
+        return None
+
+    # Compile into DataFrame with a single concat of the per-period frames
+    df = pd.concat(frames, ignore_index=True)
     # Sort by timestamp just in case (ascending chronological order)
-    df.sort_values(by='timestamp', inplace=True)
+    df.sort_values(by='timestamp', inplace=True, kind='stable')
     df.reset_index(drop=True, inplace=True)
     # If multiple time series contributed the same (timestamp, production_type) (which can happen if data overlaps),
     # drop duplicate entries (keeping the first). This prevents double-counting in case of overlapping intervals.
@@ -184,8 +232,105 @@ def retrieve_entsoe_data(area_code: str, dataset_key: str, start_date: datetime,
     logging.info(f"Retrieved {len(df)} records for {dataset_key}, area {area_code}.")
     return df
 
-def retrieve_entsoe_datasets(countries: dict, datasets: list, start_date: datetime, end_date: datetime, output_folder: str):
-    """Retrieve specified datasets for given countries within [start_date, end_date). Save results to CSV and JSON."""
+async def _retrieve_bulk(session, semaphore, area_code, dataset_key, windows, limiter=None, cache=None):
+    """Fetch contiguous, settled windows with a single request; None when that is not possible or returns nothing."""
+    start_date, end_date = windows[0][0], windows[-1][1]
+    contiguous = all(previous[1] == current[0] for previous, current in zip(windows, windows[1:]))
+    if (len(windows) < 2 or not contiguous
+            or end_date - start_date > ENTSOE_MAX_REQUEST_SPAN or end_date > datetime.now(pytz.UTC) - ENTSOE_CACHE_SETTLE):
+        return None
+    try:
+        df = await retrieve_entsoe_data(session, semaphore, area_code, dataset_key, start_date, end_date, limiter, cache)
+    except Exception as e:
+        # A rejected bulk request (e.g. document too large) is expected and simply falls back to the windows
+        df = None
+        logging.info(f"Bulk request failed for {dataset_key}, area {area_code}: {e}")
+    if df is None or df.empty:
+        # Too much data for one document, or nothing published for the span: retry window by window
+        logging.info(f"Falling back to {len(windows)} window requests for {dataset_key}, area {area_code}.")
+        return None
+    return df
+
+async def _retrieve_windows(session, semaphore, area_code, dataset_key, windows, limiter=None, cache=None):
+    """Fetch every [start, end) window and concatenate the results once. Returns (df, failed_windows).
+
+    Failed windows are logged and skipped; windows with nothing published are not failures.
+
+    A whole settled span (e.g. a past year of monthly windows) is first tried as one request, 12x fewer calls.
+    """
+    df = await _retrieve_bulk(session, semaphore, area_code, dataset_key, windows, limiter, cache)
+    if df is not None:
+        return df, []
+
+    results = await asyncio.gather(*(
+        retrieve_entsoe_data(session, semaphore, area_code, dataset_key, start_date, end_date, limiter, cache)
+        for start_date, end_date in windows
+    ), return_exceptions=True)
+    frames, failed_windows = [], []
+    for (start_date, end_date), result in zip(windows, results):
+        if isinstance(result, Exception):
+            logging.error(f"Failed retrieving {dataset_key}, area {area_code} ({start_date:%Y-%m-%d} to {end_date:%Y-%m-%d}): {result}")
+            failed_windows.append((start_date, end_date))
+        elif result is not None and not result.empty:
+            frames.append(result)
+    if not frames:
+        return None, failed_windows
+    # Windows are disjoint and in chronological order, so a single concat keeps the series sorted
+    return pd.concat(frames, ignore_index=True), failed_windows
+
+def _save_chunk(df: pd.DataFrame, metadata: dict, csv_path: str):
+    """Write a retrieved series to CSV plus its _metadata.json sidecar."""
+    write_csv(df, csv_path)
+    logging.info(f"Saved CSV: {csv_path}")
+    if metadata.get("missing_windows"):
+        logging.warning(f"{csv_path} is missing {len(metadata['missing_windows'])} failed window(s), listed in its metadata")
+    meta_name = csv_path.replace('.csv', '_metadata.json')
+    write_json(meta_name, metadata)
+    logging.info(f"Saved metadata: {meta_name}")
+
+def _series_metadata(country_name: str, area_code: str, dataset_key: str, start_date: datetime, end_date: datetime, failed_windows=(), **extra) -> dict:
+    """Sidecar metadata; windows that failed to download are listed so the CSV does not pass for full coverage."""
+    return {
+        "country": country_name,
+        **extra,
+        "area_code": area_code,
+        "dataset": dataset_key,
+        "unit": DATASETS[dataset_key]['unit'],
+        "period_start": start_date.isoformat(),
+        "period_end": end_date.isoformat(),
+        "missing_windows": [{"start": start.isoformat(), "end": end.isoformat()} for start, end in failed_windows],
+        "retrieval_timestamp": datetime.now(pytz.UTC).isoformat()
+    }
+
+async def _retrieve_zone_prices(session, semaphore, country_name, zone_code, zone_label, dataset_key, windows, output_folder, limiter=None, cache=None):
+    start_date, end_date = windows[0][0], windows[-1][1]
+    logging.info(f"Starting retrieval of {dataset_key} for {country_name} (Zone: {zone_label}).")
+    df, failed_windows = await _retrieve_windows(session, semaphore, zone_code, dataset_key, windows, limiter, cache)
+    if df is not None and not df.empty:
+        # Construct filename with country and zone label
+        csv_name = os.path.join(output_folder, f"{country_name}_{zone_label}_{dataset_key}_{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}.csv")
+        # Metadata with zone info
+        metadata = _series_metadata(country_name, zone_code, dataset_key, start_date, end_date, failed_windows, bidding_zone=zone_label)
+        # Disk writes run in a worker thread so other series keep downloading meanwhile
+        await asyncio.to_thread(_save_chunk, df, metadata, csv_name)
+    else:
+        logging.warning(f"No data available for {country_name} (Zone: {zone_label}), dataset: {dataset_key}.")
+
+async def _retrieve_country_dataset(session, semaphore, country_name, country_code, dataset_key, windows, output_folder, limiter=None, cache=None):
+    # Non-price datasets (load, generation, etc.) use country_code directly
+    start_date, end_date = windows[0][0], windows[-1][1]
+    logging.info(f"Starting retrieval of {dataset_key} for {country_name}.")
+    df, failed_windows = await _retrieve_windows(session, semaphore, country_code, dataset_key, windows, limiter, cache)
+    if df is not None and not df.empty:
+        csv_name = os.path.join(output_folder, f"{country_name}_{dataset_key}_{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}.csv")
+        metadata = _series_metadata(country_name, country_code, dataset_key, start_date, end_date, failed_windows)
+        await asyncio.to_thread(_save_chunk, df, metadata, csv_name)
+    else:
+        logging.warning(f"No data available for {country_name}, dataset: {dataset_key}.")
+
+def _retrieval_tasks(session, semaphore, countries: dict, datasets: list, windows: list, output_folder: str, limiter=None, cache=None) -> list:
+    """One coroutine per (country, dataset, zone), each covering all windows and writing a single CSV."""
+    tasks = []
     for country_name, country_code in countries.items():
         for dataset_key in datasets:
             if dataset_key == "day_ahead_prices":
@@ -196,63 +341,41 @@ def retrieve_entsoe_datasets(countries: dict, datasets: list, start_date: dateti
                     # Default: use the country_code itself if no special zone mapping
                     zones = [(country_code, country_name)]
                 for zone_code, zone_label in zones:
-                    logging.info(f"Starting retrieval of {dataset_key} for {country_name} (Zone: {zone_label}).")
-                    df = retrieve_entsoe_data(zone_code, dataset_key, start_date, end_date)
-                    if df is not None and not df.empty:
-                        # Construct filename with country and zone label
-                        csv_name = os.path.join(output_folder, f"{country_name}_{zone_label}_{dataset_key}_{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}.csv")
-                        df.to_csv(csv_name, index=False)
-                        logging.info(f"Saved CSV: {csv_name}")
-                        # Metadata with zone info
-                        metadata = {
-                            "country": country_name,
-                            "bidding_zone": zone_label,
-                            "area_code": zone_code,
-                            "dataset": dataset_key,
-                            "unit": DATASETS[dataset_key]['unit'],
-                            "period_start": start_date.isoformat(),
-                            "period_end": end_date.isoformat(),
-                            "retrieval_timestamp": datetime.now(pytz.UTC).isoformat()
-                        }
-                        meta_name = csv_name.replace('.csv', '_metadata.json')
-                        with open(meta_name, 'w') as meta_file:
-                            json.dump(metadata, meta_file, indent=4)
-                        logging.info(f"Saved metadata: {meta_name}")
-                    else:
-                        logging.warning(f"No data available for {country_name} (Zone: {zone_label}), dataset: {dataset_key}.")
+                    tasks.append(_retrieve_zone_prices(
+                        session, semaphore, country_name, zone_code, zone_label, dataset_key,
+                        windows, output_folder, limiter, cache
+                    ))
             else:
-                # Non-price datasets (load, generation, etc.) use country_code directly
-                logging.info(f"Starting retrieval of {dataset_key} for {country_name}.")
-                df = retrieve_entsoe_data(country_code, dataset_key, start_date, end_date)
-                if df is not None and not df.empty:
-                    csv_name = os.path.join(output_folder, f"{country_name}_{dataset_key}_{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}.csv")
-                    df.to_csv(csv_name, index=False)
-                    logging.info(f"Saved CSV: {csv_name}")
-                    metadata = {
-                        "country": country_name,
-                        "area_code": country_code,
-                        "dataset": dataset_key,
-                        "unit": DATASETS[dataset_key]['unit'],
-                        "period_start": start_date.isoformat(),
-                        "period_end": end_date.isoformat(),
-                        "retrieval_timestamp": datetime.now(pytz.UTC).isoformat()
-                    }
-                    meta_name = csv_name.replace('.csv', '_metadata.json')
-                    with open(meta_name, 'w') as meta_file:
-                        json.dump(metadata, meta_file, indent=4)
-                    logging.info(f"Saved metadata: {meta_name}")
-                else:
-                    logging.warning(f"No data available for {country_name}, dataset: {dataset_key}.")
+                tasks.append(_retrieve_country_dataset(
+                    session, semaphore, country_name, country_code, dataset_key,
+                    windows, output_folder, limiter, cache
+                ))
+    return tasks
 
-# Adjusted retrieval function for day-ahead prices (monthly)
-def retrieve_monthly_entsoe_datasets(countries, datasets, year, output_folder):
+async def retrieve_entsoe_datasets(session, semaphore, countries: dict, datasets: list, start_date: datetime, end_date: datetime, output_folder: str, limiter=None, cache=None):
+    """Retrieve specified datasets for given countries within [start_date, end_date). Save results to CSV and JSON."""
+    await gather_all(_retrieval_tasks(session, semaphore, countries, datasets, [(start_date, end_date)], output_folder, limiter, cache), "ENTSO-E")
+
+def _month_windows(year: int):
     for month in range(1, 13):
         start_date = datetime(year, month, 1, tzinfo=pytz.UTC)
         if month == 12:
             end_date = datetime(year + 1, 1, 1, tzinfo=pytz.UTC)
         else:
             end_date = datetime(year, month + 1, 1, tzinfo=pytz.UTC)
-        
-        logging.info(f"=== Retrieving data for {start_date.strftime('%B %Y')} ===")
-        retrieve_entsoe_datasets(countries, datasets, start_date, end_date, output_folder)
+        yield start_date, end_date
+
+# Adjusted retrieval function for day-ahead prices (monthly)
+async def retrieve_monthly_entsoe_datasets_async(session, semaphore, countries, datasets, year, output_folder, limiter=None, cache=None):
+    """Retrieve a year per (country, dataset, zone), in one request or month by month, and write one CSV per series."""
+    tasks = _retrieval_tasks(session, semaphore, countries, datasets, list(_month_windows(year)), output_folder, limiter, cache)
+    logging.info(f"=== Retrieving {len(tasks)} ENTSO-E series for {year} ===")
+    await gather_all(tasks, "ENTSO-E")
 
+def retrieve_monthly_entsoe_datasets(countries, datasets, year, output_folder, limiter=None, cache=None):
+    """Synchronous entry point: runs the concurrent retrieval on its own session and event loop."""
+    async def _run():
+        async with create_session() as session:
+            semaphore = asyncio.Semaphore(ENTSOE_MAX_CONCURRENT_REQUESTS)
+            await retrieve_monthly_entsoe_datasets_async(session, semaphore, countries, datasets, year, output_folder, limiter, cache)
+    asyncio.run(_run())
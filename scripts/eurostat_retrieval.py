@@ -1,9 +1,10 @@
 import eurostat
 import pandas as pd
-import json
 import os
 import logging
 from datetime import datetime
+from pathlib import Path
+from scripts.io_utils import ensure_dir, is_fresh, write_csv, write_json
 
 EUROSTAT_DATASETS = {
     "annual_energy_balances": "nrg_bal_s",
@@ -21,10 +22,30 @@ EUROSTAT_DATASETS = {
     "energy_import_dependency": "nrg_ind_id"  
 }
 
-def fetch_eurostat_data(dataset_code, countries):
+def get_data_df_cached(dataset_code, cache_dir=None, cache_ttl=None, force_refresh=False):
+    """eurostat.get_data_df, kept as <cache_dir>/<dataset_code>.parquet and reused while younger than cache_ttl seconds."""
+    cache_path = Path(cache_dir) / f"{dataset_code}.parquet" if cache_dir else None
+    if cache_path and not force_refresh and is_fresh(cache_path, cache_ttl):
+        try:
+            df = pd.read_parquet(cache_path)
+            logging.info(f"Using cached Eurostat dataset {dataset_code}")
+            return df
+        except Exception as e:
+            logging.warning(f"Unreadable cached Eurostat dataset {dataset_code}, downloading it again: {e}")
+
+    df = eurostat.get_data_df(dataset_code, flags=False)
+    if cache_path:
+        ensure_dir(cache_dir)
+        # Write-then-rename so an interrupted write never leaves a truncated cache file behind
+        part_path = cache_path.with_suffix('.part')
+        df.to_parquet(part_path, index=False)
+        os.replace(part_path, cache_path)
+    return df
+
+def fetch_eurostat_data(dataset_code, countries, cache_dir=None, cache_ttl=None, force_refresh=False):
     logging.info(f"Fetching Eurostat data for dataset {dataset_code}")
     try:
-        df = eurostat.get_data_df(dataset_code, flags=False)
+        df = get_data_df_cached(dataset_code, cache_dir, cache_ttl, force_refresh)
     except Exception as e:
         logging.error(f"Failed to fetch dataset {dataset_code}: {e}")
         raise
@@ -37,29 +58,32 @@ def fetch_eurostat_data(dataset_code, countries):
     df_filtered = df[df[geo_col].isin(countries)].copy()
     year_cols = [col for col in df_filtered.columns if col[0].isdigit()]
 
-    df_long = df_filtered.melt(
-        id_vars=[col for col in df_filtered.columns if col not in year_cols],
-        value_vars=year_cols,
-        var_name='period',
-        value_name='value'
+    id_cols = [col for col in df_filtered.columns if col not in year_cols]
+
+    # Stack the period columns under the id index in one pass instead of melt's per-column copies
+    df_long = (
+        df_filtered.set_index(id_cols)[year_cols]
+        .rename_axis(columns='period')
+        .stack(future_stack=True)
+        .dropna()
+        .reset_index(name='value')
     )
 
-    df_long.dropna(subset=['value'], inplace=True)
-    
-    df_long['year'] = df_long['period'].str.extract('(\d{4})').astype(int)
+    # Eurostat period codes (2020, 2020-Q1, 2020M01, 2020-S1) always start with the 4-digit year
+    df_long['year'] = df_long['period'].str[:4].astype('int32')
     df_long['period_detail'] = df_long['period']
 
     logging.info(f"Fetched {len(df_long)} records for dataset {dataset_code}")
 
     return df_long
 
-def retrieve_eurostat_datasets(output_dir, start_year=None, countries=None):
-    os.makedirs(output_dir, exist_ok=True)
+def retrieve_eurostat_datasets(output_dir, start_year=None, countries=None, cache_dir=None, cache_ttl=None, force_refresh=False):
+    ensure_dir(output_dir)
     for dataset_name, dataset_code in EUROSTAT_DATASETS.items():
         logging.info(f"Retrieving Eurostat dataset: {dataset_name} ({dataset_code})")
 
         try:
-            df = fetch_eurostat_data(dataset_code, countries)
+            df = fetch_eurostat_data(dataset_code, countries, cache_dir, cache_ttl, force_refresh)
             
             if start_year:
                 df = df[df['year'] >= start_year]
@@ -72,7 +96,7 @@ def retrieve_eurostat_datasets(output_dir, start_year=None, countries=None):
             csv_path = os.path.join(output_dir, f"{dataset_name}.csv")
             metadata_path = os.path.join(output_dir, f"{dataset_name}_metadata.json")
 
-            df.to_csv(csv_path, index=False)
+            write_csv(df, csv_path)
             logging.info(f"Saved dataset CSV: {csv_path}")
 
             metadata = {
@@ -90,8 +114,7 @@ def retrieve_eurostat_datasets(output_dir, start_year=None, countries=None):
                 }
             }
 
-            with open(metadata_path, 'w', encoding='utf-8') as meta_file:
-                json.dump(metadata, meta_file, ensure_ascii=False, indent=4)
+            write_json(metadata_path, metadata)
             logging.info(f"Saved metadata JSON: {metadata_path}")
 
         except Exception as e:
@@ -0,0 +1,228 @@
+import os
+import gzip
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import aiohttp
+from pathlib import Path
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, stop_after_delay, wait_exponential_jitter
+from scripts.io_utils import ensure_dir, is_fresh
+
+# Global cap on in-flight requests across all retrieval tasks
+MAX_CONCURRENT_REQUESTS = 64
+# Per-host connection cap to stay clear of server-side throttling (HTTP 429)
+MAX_CONNECTIONS_PER_HOST = 8
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=600)
+MAX_ATTEMPTS = 5
+# Give up on a request once this many seconds have been spent retrying it
+MAX_RETRY_TIME = 120
+# Bytes of an error body decoded into log messages and exceptions
+ERROR_BODY_LIMIT = 500
+# ENTSO-E reports throttling in an Acknowledgement document rather than with HTTP 429
+RATE_LIMIT_MARKERS = (b"TOO_MANY_REQUESTS",)
+# Credentials carried in the query string, stripped from every URL that is logged or put into an exception
+REDACTED_QUERY_PARAMS = ("securityToken",)
+
+class RetryableHTTPError(Exception):
+    """Raised for responses worth retrying (HTTP 429, 5xx and rate-limit error bodies)."""
+    def __init__(self, status: int, url: str, retry_after: float = 0.0):
+        super().__init__(f"HTTP {status} for {url}")
+        self.status = status
+        self.retry_after = retry_after
+
+class AsyncRateLimiter:
+    """Token bucket shared by all coroutines talking to one host."""
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def pause(self, delay: float):
+        """Drain the bucket so that no request is issued for the next `delay` seconds."""
+        self._refill()
+        self.tokens = min(self.tokens, 1 - delay * self.rate)
+
+    def update_from_headers(self, headers):
+        """Self-tune from X-RateLimit-* headers when the server sends them."""
+        remaining = _header_float(headers, "X-RateLimit-Remaining")
+        if remaining is None:
+            return
+        self._refill()
+        # Never hold more tokens than the server says are left in its window
+        self.tokens = min(self.tokens, remaining)
+        reset = _header_float(headers, "X-RateLimit-Reset")
+        if remaining < 1 and reset:
+            # Reset is either seconds-until-reset or an epoch timestamp
+            self.pause(reset - time.time() if reset > 1e9 else reset)
+
+def _header_float(headers, name: str):
+    try:
+        return float(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+def _retry_after(headers) -> float:
+    """Parse Retry-After given either as seconds or as an HTTP date."""
+    value = headers.get("Retry-After")
+    if not value:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return 0.0
+
+def redact_url(url) -> str:
+    """Render a response URL without its credential query parameters, for logs and error messages."""
+    return str(url.with_query([(k, v) for k, v in url.query.items() if k not in REDACTED_QUERY_PARAMS]))
+
+def check_retryable(response: aiohttp.ClientResponse, limiter: AsyncRateLimiter = None):
+    """Feed rate-limit headers to the limiter and raise RetryableHTTPError on 429/5xx."""
+    if limiter:
+        limiter.update_from_headers(response.headers)
+    if response.status == 429 or response.status >= 500:
+        delay = _retry_after(response.headers)
+        if delay and limiter:
+            # Hold back every coroutine sharing this host, not just the one that was throttled
+            limiter.pause(delay)
+        url = redact_url(response.url)
+        logging.warning(f"HTTP {response.status} for {url} (Retry-After: {delay:.1f}s)")
+        raise RetryableHTTPError(response.status, url, retry_after=delay)
+
+def error_excerpt(body: bytes, limit: int = ERROR_BODY_LIMIT) -> str:
+    """Decode only the head of an error body for logging; response bodies are otherwise kept as bytes."""
+    excerpt = body[:limit].decode(errors='replace')
+    return excerpt + "..." if len(body) > limit else excerpt
+
+def check_rate_limit_body(response: aiohttp.ClientResponse, body: bytes):
+    """Raise RetryableHTTPError when a non-200 body carries a rate-limit error text."""
+    if response.status != 200 and any(marker in body for marker in RATE_LIMIT_MARKERS):
+        url = redact_url(response.url)
+        logging.warning(f"Rate limited by {url} (HTTP {response.status})")
+        raise RetryableHTTPError(response.status, url)
+
+_backoff = wait_exponential_jitter(initial=1, max=60)
+
+def _wait_for_retry(retry_state) -> float:
+    """Exponential backoff with jitter, but never shorter than the server's Retry-After."""
+    error = retry_state.outcome.exception()
+    return max(_backoff(retry_state), getattr(error, "retry_after", 0.0))
+
+# Exponential backoff with jitter on throttling, server errors and dropped connections
+http_retry = retry(
+    retry=retry_if_exception_type((RetryableHTTPError, aiohttp.ClientError, asyncio.TimeoutError)),
+    stop=stop_after_attempt(MAX_ATTEMPTS) | stop_after_delay(MAX_RETRY_TIME),
+    wait=_wait_for_retry,
+    reraise=True
+)
+
+async def gather_all(tasks, description: str = "retrieval"):
+    """Await every task to completion, log each failure, then raise if any failed."""
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    failures = [result for result in results if isinstance(result, Exception)]
+    for failure in failures:
+        logging.error(f"{description.capitalize()} task failed: {failure}")
+    if failures:
+        raise Exception(f"{len(failures)} of {len(results)} {description} tasks failed")
+    return results
+
+class ResponseCache:
+    """Gzipped on-disk cache of HTTP 200 bodies keyed by URL and query parameters.
+
+    Entries younger than ttl_seconds are served without a request. Older entries are revalidated with
+    If-None-Match / If-Modified-Since when the server sent an ETag or Last-Modified, and refetched otherwise.
+    """
+    def __init__(self, directory, ttl_seconds: float = None, force_refresh: bool = False, ignored_params=()):
+        self.directory = ensure_dir(directory)
+        self.ttl_seconds = ttl_seconds
+        self.force_refresh = force_refresh
+        # Credentials and similar parameters that must not end up in (or change) the key
+        self.ignored_params = set(ignored_params)
+
+    def _path(self, url: str, params: dict = None) -> Path:
+        key_params = sorted((k, str(v)) for k, v in (params or {}).items() if k not in self.ignored_params)
+        digest = hashlib.sha256(json.dumps([url, key_params]).encode()).hexdigest()
+        return self.directory / f"{digest}.gz"
+
+    def lookup(self, url: str, params: dict = None):
+        """Return (body, validator_headers): body is set for a fresh hit, headers for a stale entry worth revalidating."""
+        path = self._path(url, params)
+        if self.force_refresh or not path.exists():
+            return None, {}
+        if is_fresh(path, self.ttl_seconds):
+            return gzip.decompress(path.read_bytes()), {}
+        try:
+            validators = json.loads(path.with_suffix('.json').read_text())
+        except (OSError, ValueError):
+            return None, {}
+        headers = {}
+        if validators.get("ETag"):
+            headers["If-None-Match"] = validators["ETag"]
+        if validators.get("Last-Modified"):
+            headers["If-Modified-Since"] = validators["Last-Modified"]
+        return None, headers
+
+    def revalidated(self, url: str, params: dict = None) -> bytes:
+        """Mark a stale entry as fresh again after a 304 and return its body."""
+        path = self._path(url, params)
+        os.utime(path)
+        return gzip.decompress(path.read_bytes())
+
+    def store(self, url: str, params: dict, body: bytes, headers):
+        path = self._path(url, params)
+        # Write-then-rename so a crash never leaves a truncated entry behind
+        part = path.with_suffix('.part')
+        part.write_bytes(gzip.compress(body, compresslevel=6))
+        os.replace(part, path)
+        validators = {name: headers[name] for name in ("ETag", "Last-Modified") if name in headers}
+        path.with_suffix('.json').write_text(json.dumps(validators))
+
+def create_session() -> aiohttp.ClientSession:
+    """Create an aiohttp session with a per-host connection limit."""
+    connector = aiohttp.TCPConnector(limit_per_host=MAX_CONNECTIONS_PER_HOST)
+    return aiohttp.ClientSession(connector=connector, timeout=REQUEST_TIMEOUT)
+
+@http_retry
+async def fetch(session: aiohttp.ClientSession, url: str, semaphore, params: dict = None, limiter: AsyncRateLimiter = None, cache: ResponseCache = None):
+    """GET a URL while holding the shared semaphore. Returns (status, body bytes); 200 bodies go through the cache if given."""
+    headers = {}
+    if cache:
+        body, headers = await asyncio.to_thread(cache.lookup, url, params)
+        if body is not None:
+            logging.debug(f"Cache hit for {url}")
+            return 200, body
+    async with semaphore:
+        if limiter:
+            await limiter.acquire()
+        async with session.get(url, params=params, headers=headers) as response:
+            check_retryable(response, limiter)
+            body = await response.read()
+            check_rate_limit_body(response, body)
+            logging.debug(f"GET {redact_url(response.url)} -> HTTP {response.status} ({len(body)} bytes)")
+            status, response_headers = response.status, response.headers
+    if cache and status == 304:
+        return 200, await asyncio.to_thread(cache.revalidated, url, params)
+    if cache and status == 200:
+        await asyncio.to_thread(cache.store, url, params, body, response_headers)
+    return status, body
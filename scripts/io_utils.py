@@ -0,0 +1,88 @@
+import os
+import time
+import orjson
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+from pathlib import Path
+
+# Directories already created (or verified) during this run, including their parents
+_created_dirs = set()
+
+def ensure_dir(path) -> Path:
+    """Create a directory tree once per run; repeat calls for it or any of its parents skip the syscalls."""
+    path = os.path.normpath(path)
+    if path not in _created_dirs:
+        Path(path).mkdir(parents=True, exist_ok=True)
+        parent = path
+        while parent and parent not in _created_dirs:
+            _created_dirs.add(parent)
+            parent = os.path.dirname(parent)
+    return Path(path)
+
+def is_fresh(path, ttl_seconds: float = None) -> bool:
+    """True if path exists and was written less than ttl_seconds ago (any age when ttl_seconds is None)."""
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        return False
+    return ttl_seconds is None or age < ttl_seconds
+
+def write_csv(df, path) -> Path:
+    """Write a DataFrame (without its index) through Arrow's multithreaded C++ CSV writer instead of DataFrame.to_csv."""
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), path)
+    return Path(path)
+
+def first_occurrences(table: pa.Table, key_columns) -> np.ndarray:
+    """Sorted row indices of the first row per distinct key, via np.unique on the key columns packed into one int64.
+
+    String columns are dictionary-encoded; temporal columns are offset from their minimum, which keeps a year of
+    nanosecond timestamps times a few dozen categories well inside int64. Keys that would overflow the packing are
+    compared column-wise instead.
+    """
+    if table.num_rows == 0:
+        return np.empty(0, dtype=np.int64)
+    columns, key_space = [], 1
+    for column in key_columns:
+        values = table[column].combine_chunks()
+        if pa.types.is_string(values.type) or pa.types.is_large_string(values.type):
+            encoded = pc.dictionary_encode(values)
+            codes = encoded.indices.to_numpy(zero_copy_only=False).astype(np.int64)
+            cardinality = len(encoded.dictionary)
+        else:
+            codes = values.to_numpy(zero_copy_only=False).astype(np.int64)
+            codes = codes - codes.min()
+            cardinality = int(codes.max()) + 1
+        columns.append((codes, cardinality))
+        # Python ints do not overflow, so this is the exact size of the packed key space
+        key_space *= cardinality
+    if key_space <= np.iinfo(np.int64).max:
+        keys = np.zeros(table.num_rows, dtype=np.int64)
+        for codes, cardinality in columns:
+            keys = keys * cardinality + codes
+        _, first_rows = np.unique(keys, return_index=True)
+    else:
+        _, first_rows = np.unique(np.column_stack([codes for codes, _ in columns]), axis=0, return_index=True)
+    return np.sort(first_rows)
+
+# Two-space indent is the only indent orjson offers; NumPy scalars serialize natively, anything else via str()
+JSON_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
+
+def write_json(path, obj) -> Path:
+    """Encode obj with orjson and write it in a single binary write (UTF-8, non-ASCII kept as-is)."""
+    with open(path, 'wb') as json_file:
+        json_file.write(orjson.dumps(obj, default=str, option=JSON_OPTIONS))
+    return Path(path)
+
+METADATA_INDEX_FILENAME = "metadata.jsonl"
+
+def write_metadata_index(output_dir, records) -> Path:
+    """Write one metadata record per line to <output_dir>/metadata.jsonl (read back with pd.read_json(lines=True))."""
+    index_path = Path(output_dir) / METADATA_INDEX_FILENAME
+    with open(index_path, 'wb') as index_file:
+        index_file.write(b"".join(
+            orjson.dumps(record, default=str, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE)
+            for record in records
+        ))
+    return index_path
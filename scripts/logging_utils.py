@@ -0,0 +1,32 @@
+import os
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+@contextmanager
+def worker_log_queue():
+    """Yield a queue that worker processes log into; records are handled by this process's handlers."""
+    queue = multiprocessing.Queue(-1)
+    listener = QueueListener(queue, *logging.getLogger().handlers, respect_handler_level=True)
+    listener.start()
+    try:
+        yield queue
+    finally:
+        listener.stop()
+        queue.close()
+
+def init_worker_logging(queue):
+    """Pool initializer: route all worker logging through the parent's queue instead of shared files."""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(queue))
+    root.setLevel(logging.INFO)
+
+def map_in_processes(function, *iterables, chunksize=4) -> list:
+    """executor.map over a process pool whose workers log through this process's handlers; results in input order."""
+    with worker_log_queue() as log_queue:
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_worker_logging, initargs=(log_queue,)) as executor:
+            return list(executor.map(function, *iterables, chunksize=chunksize))
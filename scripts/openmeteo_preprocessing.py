@@ -1,79 +1,90 @@
 import os
+import re
 import pandas as pd
-import json
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import orjson
 import logging
+from collections import defaultdict
+from itertools import repeat
 from pathlib import Path
-from glob import glob
+from scripts.logging_utils import map_in_processes
+from scripts.io_utils import ensure_dir, first_occurrences, write_json
 
-def merge_monthly_weather_to_yearly(input_folder, output_folder):
-    input_path = Path(input_folder)
-    output_path = Path(output_folder)
-    output_path.mkdir(parents=True, exist_ok=True)
+# {country}_{city}_{YYYY-MM-DD}_{YYYY-MM-DD}.parquet; multi-word cities keep their underscores
+WEATHER_FILENAME_RE = re.compile(r'^(?P<country>[^_]+)_(?P<city>.+)_(?P<year>\d{4})-\d{2}-\d{2}_\d{4}-\d{2}-\d{2}\.parquet$')
 
-    monthly_files = glob(str(input_path / '*.csv'))
-    file_groups = {}
+def _load_json(path):
+    with open(path, 'rb') as file:
+        return orjson.loads(file.read())
 
-    for filepath in monthly_files:
-        filename = os.path.basename(filepath)
-        parts = filename.split('_')
+def merge_monthly_weather_to_yearly(input_folder, output_folder, output_format='parquet'):
+    input_path = Path(input_folder)
+    output_path = ensure_dir(output_folder)
 
-        if len(parts) >= 4:
-            country = parts[0]
-            city = parts[1]
-            start_date = parts[2]
-            year = start_date[:4]
+    file_groups = defaultdict(list)
 
-            key = (country, city, year)
-            file_groups.setdefault(key, []).append(filepath)
+    for path in input_path.glob('*.parquet'):
+        match = WEATHER_FILENAME_RE.match(path.name)
+        if match:
+            file_groups[match.group('country', 'city', 'year')].append(str(path))
 
-    # Merge files explicitly per key
-    for (country, city, year), files in file_groups.items():
-        try:
-            logging.info(f"Merging weather data for {city}, {country}, year {year}")
+    # Groups are independent, so merge them in parallel across processes
+    keys = list(file_groups)
+    files_list = [file_groups[key] for key in keys]
+    map_in_processes(_merge_group, keys, files_list, repeat(output_path), repeat(output_format))
 
-            combined_df = pd.concat((pd.read_csv(f) for f in files), ignore_index=True)
+def _merge_group(key, files, output_path, output_format='parquet'):
+    country, city, year = key
+    try:
+        logging.info(f"Merging weather data for {city}, {country}, year {year}")
 
-            # Convert 'date' explicitly to datetime
-            combined_df['date'] = pd.to_datetime(combined_df['date'])
-            combined_df.sort_values('date', inplace=True)
+        # Typed columnar reads; nothing is re-parsed from text
+        table = ds.dataset(files, format='parquet').to_table()
+        table = table.sort_by('date')
 
-            # Drop duplicates explicitly
-            combined_df.drop_duplicates(subset=['date'], keep='first', inplace=True)
+        # Drop duplicates explicitly
+        table = table.take(first_occurrences(table, ['date']))
 
-            # Explicitly construct filename
-            yearly_filename = f"{country}_{city}_{year}.csv"
-            combined_df.to_csv(output_path / yearly_filename, index=False)
+        # Explicitly construct filename
+        yearly_stem = f"{country}_{city}_{year}"
+        if output_format == 'csv':
+            yearly_filename = f"{yearly_stem}.csv"
+            pacsv.write_csv(table, output_path / yearly_filename)
+        else:
+            yearly_filename = f"{yearly_stem}.parquet"
+            pq.write_table(table, output_path / yearly_filename, compression='snappy')
 
-            # Explicitly handle metadata
-            metadata_files = [f.replace('.csv', '_metadata.json') for f in files]
-            metadata_details = []
-            for mf in metadata_files:
-                if os.path.exists(mf):
-                    with open(mf, 'r', encoding='utf-8') as file:
-                        metadata_details.append(json.load(file))
+        # Explicitly handle metadata: the variable descriptions are identical across source files, so only the first is read
+        first_metadata_file = files[0].replace('.parquet', '_metadata.json')
+        source_metadata = _load_json(first_metadata_file) if os.path.exists(first_metadata_file) else {}
 
-            # Prepare yearly metadata explicitly
-            metadata = {
-                "country": country,
-                "city": city,
-                "year": year,
-                "variables": metadata_details[0]["variables"] if metadata_details else {},
-                "daily_value_description": metadata_details[0]["daily_value_description"] if metadata_details else "",
-                "unit": "varies",  # since multiple variables have different units
-                "period_start": combined_df['date'].min().strftime('%Y-%m-%d'),
-                "period_end": combined_df['date'].max().strftime('%Y-%m-%d'),
-                "source": "Open-Meteo Archive API",
-                "license": "Open data (Open-Meteo)",
-                "retrieval_timestamp": pd.Timestamp.now().isoformat(),
-                "source_files": [os.path.basename(f) for f in files]
-            }
+        # Prepare yearly metadata explicitly
+        period = pc.min_max(table['date'])
+        metadata = {
+            # Filename tokens cannot tell "czech_republic_prague" apart, so prefer the names recorded at retrieval
+            "country": source_metadata.get("country", country),
+            "city": source_metadata.get("city", city),
+            "year": year,
+            "data_file": yearly_filename,
+            "variables": source_metadata.get("variables", {}),
+            "daily_value_description": source_metadata.get("daily_value_description", ""),
+            "unit": "varies",  # since multiple variables have different units
+            "period_start": period['min'].as_py().strftime('%Y-%m-%d'),
+            "period_end": period['max'].as_py().strftime('%Y-%m-%d'),
+            "source": "Open-Meteo Archive API",
+            "license": "Open data (Open-Meteo)",
+            "retrieval_timestamp": pd.Timestamp.now().isoformat(),
+            "source_files": [os.path.basename(f) for f in files]
+        }
 
-            metadata_filename = yearly_filename.replace('.csv', '_metadata.json')
-            with open(output_path / metadata_filename, 'w', encoding='utf-8') as meta_file:
-                json.dump(metadata, meta_file, indent=4)
+        metadata_filename = f"{yearly_stem}_metadata.json"
+        write_json(output_path / metadata_filename, metadata)
 
-            logging.info(f"Saved yearly weather data: {yearly_filename}")
-            logging.info(f"Saved yearly metadata: {metadata_filename}")
+        logging.info(f"Saved yearly weather data: {yearly_filename}")
+        logging.info(f"Saved yearly metadata: {metadata_filename}")
 
-        except Exception as e:
-            logging.error(f"Error merging data for {city}, {country}, {year}: {e}")
\ No newline at end of file
+    except Exception as e:
+        logging.error(f"Error merging data for {city}, {country}, {year}: {e}")
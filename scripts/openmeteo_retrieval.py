@@ -1,12 +1,19 @@
 import os
-import requests
-import pandas as pd
-import json
+import asyncio
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
 import logging
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
+from scripts.http_utils import error_excerpt, fetch
+from scripts.io_utils import ensure_dir, write_json
 
 # Open-Meteo API endpoint
 API_URL = "https://archive-api.open-meteo.com/v1/archive"
+# Concurrent Open-Meteo requests in flight, on top of the per-host rate limiter
+OPENMETEO_MAX_CONCURRENT_REQUESTS = 16
+# The archive trails real time by a few days and rejects end dates beyond what it holds (HTTP 400)
+ARCHIVE_LAG = timedelta(days=5)
 
 # Weather variables
 WEATHER_VARIABLES = [
@@ -19,7 +26,7 @@ WEATHER_VARIABLES = [
     "relative_humidity_2m_mean"
 ]
 
-def fetch_weather_data(country, city, lat, lon, start_date, end_date):
+async def fetch_weather_data(session, semaphore, country, city, lat, lon, start_date, end_date, limiter=None):
     params = {
         "latitude": lat,
         "longitude": lon,
@@ -28,21 +35,26 @@ def fetch_weather_data(country, city, lat, lon, start_date, end_date):
         "daily": ','.join(WEATHER_VARIABLES),
         "timezone": "UTC"
     }
-    response = requests.get(API_URL, params=params)
-    if response.status_code == 200:
-        return response.json()
+    status, body = await fetch(session, API_URL, semaphore, params=params, limiter=limiter)
+    if status == 200:
+        return orjson.loads(body)
     else:
-        logging.error(f"API error {response.status_code} for {city}, {country}: {response.text}")
-        raise Exception(f"API error {response.status_code}: {response.text}")
+        text = error_excerpt(body)
+        logging.error(f"API error {status} for {city}, {country}: {text}")
+        raise Exception(f"API error {status}: {text}")
 
 def save_weather_data(country, city, data, start_date, end_date, output_dir):
-    df = pd.DataFrame(data["daily"])
-    df["date"] = pd.to_datetime(df["time"])
-    df.drop(columns=["time"], inplace=True)
+    # The daily payload is already columnar ({"time": [...], variable: [...]}), so build the Arrow table straight from it
+    daily = data["daily"]
+    variables = [name for name in daily if name != "time"]
+    # Same layout as before: variables in payload order, 'date' last (typed date32 instead of ISO text)
+    table = pa.table(
+        [pa.array(daily[name], type=pa.float64()) for name in variables] + [pa.array(daily["time"]).cast(pa.date32())],
+        names=variables + ["date"]
+    )
 
-    csv_filename = f"{country.lower().replace(' ','_')}_{city.lower().replace(' ','_')}_{start_date}_{end_date}.csv"
-    csv_path = os.path.join(output_dir, csv_filename)
-    df.to_csv(csv_path, index=False)
+    data_filename = f"{country.lower().replace(' ','_')}_{city.lower().replace(' ','_')}_{start_date}_{end_date}.parquet"
+    pq.write_table(table, os.path.join(output_dir, data_filename), compression='snappy')
 
     metadata = {
         "country": country,
@@ -67,41 +79,64 @@ def save_weather_data(country, city, data, start_date, end_date, output_dir):
         "start_date": start_date,
         "end_date": end_date,
         "retrieved_timestamp": datetime.utcnow().isoformat() + "Z",
-        "csv_file": csv_filename,
+        "data_file": data_filename,
         "api_url": API_URL
     }
 
-    metadata_filename = csv_filename.replace('.csv', '_metadata.json')
+    metadata_filename = data_filename.replace('.parquet', '_metadata.json')
     metadata_path = os.path.join(output_dir, metadata_filename)
 
-    with open(metadata_path, 'w', encoding='utf-8') as mf:
-        json.dump(metadata, mf, ensure_ascii=False, indent=4)
+    write_json(metadata_path, metadata)
 
     logging.info(f"Saved data and metadata for {city}, {country} from {start_date} to {end_date}")
 
-def retrieve_yearly_weather(countries_coords, start_year, end_year, output_dir):
-    os.makedirs(output_dir, exist_ok=True)
-    
-    for year in range(start_year, end_year + 1):
-        logging.info(f"Retrieving weather data for year: {year}")
+def _year_window(year):
+    """[start, end] date strings for a calendar year, cut at the newest archived day; None if the year is not archived yet."""
+    start = date(year, 1, 1)
+    end = min(date(year, 12, 31), datetime.now(timezone.utc).date() - ARCHIVE_LAG)
+    if end < start:
+        return None
+    return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
 
-        start_date = datetime(year, 1, 1)
-        end_date = datetime(year, 12, 31)
+async def _fetch_city_year(session, semaphore, country, city, lat, lon, s_date, e_date, limiter=None):
+    try:
+        data = await fetch_weather_data(session, semaphore, country, city, lat, lon, s_date, e_date, limiter)
+    except Exception as e:
+        logging.error(f"Failed for {city}, {country} ({s_date} to {e_date}): {e}")
+        return None
+    return country, city, data, s_date, e_date
 
-        for country, cities in countries_coords.items():
-            for city, (lat, lon) in cities.items():
-                logging.info(f"Retrieving data for {city}, {country}, Year: {year}")
-                
-                current_start = start_date
-                while current_start <= end_date:
-                    current_end = min(current_start + timedelta(days=30), end_date)
-                    s_date = current_start.strftime('%Y-%m-%d')
-                    e_date = current_end.strftime('%Y-%m-%d')
+async def _retrieve_city_years(session, semaphore, city_years, output_dir, limiter=None):
+    """Fetch (country, city, lat, lon, s_date, e_date) city-years concurrently and save each one as soon as it arrives."""
+    tasks = [
+        _fetch_city_year(session, semaphore, country, city, lat, lon, s_date, e_date, limiter)
+        for country, city, lat, lon, s_date, e_date in city_years
+    ]
+    for next_done in asyncio.as_completed(tasks):
+        result = await next_done
+        if result is None:
+            continue
+        country, city, data, s_date, e_date = result
+        try:
+            # Disk writes run in a worker thread so responses keep arriving meanwhile
+            await asyncio.to_thread(save_weather_data, country, city, data, s_date, e_date, output_dir)
+        except Exception as e:
+            logging.error(f"Failed saving {city}, {country} ({s_date} to {e_date}): {e}")
 
-                    try:
-                        data = fetch_weather_data(country, city, lat, lon, s_date, e_date)
-                        save_weather_data(country, city, data, s_date, e_date, output_dir)
-                    except Exception as e:
-                        logging.error(f"Failed for {city}, {country} ({s_date} to {e_date}): {e}")
+async def retrieve_yearly_weather(session, semaphore, countries_coords, start_year, end_year, output_dir, limiter=None):
+    ensure_dir(output_dir)
 
-                    current_start = current_end + timedelta(days=1)
\ No newline at end of file
+    windows = [_year_window(year) for year in range(start_year, end_year + 1)]
+    skipped_years = [year for year, window in zip(range(start_year, end_year + 1), windows) if window is None]
+    if skipped_years:
+        logging.warning(f"Skipping years not yet in the Open-Meteo archive: {skipped_years}")
+
+    # One whole-year request per (year, country, city), all sharing the session and semaphore
+    city_years = [
+        (country, city, lat, lon, *window)
+        for window in windows if window
+        for country, cities in countries_coords.items()
+        for city, (lat, lon) in cities.items()
+    ]
+    logging.info(f"Retrieving weather data for {len(city_years)} city-years ({start_year}-{end_year})")
+    await _retrieve_city_years(session, semaphore, city_years, output_dir, limiter)